@@ -0,0 +1,117 @@
+import re
+import threading
+import time
+
+from boto.exception import EC2ResponseError
+
+_instance_id = re.compile(r"i-\w+")
+
+
+def _invalid_ids(exc, ec2_ids):
+    """
+    Returns the IDs in ``ec2_ids`` that ``exc`` reports as invalid. EC2 names
+    them in the message of its ``InvalidInstanceID.*`` errors.
+    """
+    if not (exc.error_code or "").startswith("InvalidInstanceID."):
+        return []
+    named = set(_instance_id.findall(exc.error_message or ""))
+    return [ec2_id for ec2_id in ec2_ids if ec2_id in named]
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.ids = []
+        self.results = {}
+        self.errors = {}
+        self.done = threading.Event()
+
+
+class DescribeBatcher(object):
+    """
+    Merges describes for single instances that arrive within ``window``
+    seconds of each other into one multi-ID describe.
+
+    The first caller of a batch waits for the window to close and then runs
+    the describe for everyone, the other callers wait for its results.
+    Callers asking for an instance that is already being described share
+    that call instead of starting a new one.
+    """
+
+    def __init__(self, window=0.005):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = None
+        self._in_flight = {}
+
+    def describe(self, ec2_id, fetch):
+        """
+        Returns the snapshot for ``ec2_id``, or ``None`` if it was not found.
+        ``fetch`` receives a list of IDs and returns a dict mapping each ID
+        found to its snapshot.
+        """
+        leader = False
+        with self._lock:
+            batch = self._in_flight.get(ec2_id)
+            if batch is None:
+                if self._pending is None:
+                    self._pending = _Batch()
+                    leader = True
+                batch = self._pending
+                batch.ids.append(ec2_id)
+                self._in_flight[ec2_id] = batch
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                self._pending = None
+            self._run(batch, fetch)
+        else:
+            batch.done.wait()
+        if ec2_id in batch.errors:
+            raise batch.errors[ec2_id]
+        return batch.results.get(ec2_id)
+
+    def _run(self, batch, fetch):
+        try:
+            self._fetch(batch, batch.ids, fetch, retry=True)
+        finally:
+            with self._lock:
+                for ec2_id in batch.ids:
+                    if self._in_flight.get(ec2_id) is batch:
+                        del self._in_flight[ec2_id]
+            batch.done.set()
+
+    def _fetch(self, batch, ec2_ids, fetch, retry):
+        try:
+            batch.results.update(fetch(ec2_ids))
+        except EC2ResponseError as exc:
+            invalid = _invalid_ids(exc, ec2_ids)
+            if not retry or not invalid:
+                self._fail(batch, ec2_ids, exc)
+                return
+            # one bad ID fails the whole describe, so describe the others
+            # again without it.
+            self._fail(batch, invalid, exc)
+            valid = [ec2_id for ec2_id in ec2_ids if ec2_id not in invalid]
+            if valid:
+                self._fetch(batch, valid, fetch, retry=False)
+        except Exception as exc:
+            self._fail(batch, ec2_ids, exc)
+
+    def _fail(self, batch, ec2_ids, exc):
+        for ec2_id in ec2_ids:
+            batch.errors[ec2_id] = exc
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def shared_batcher(window):
+    """
+    Returns the batcher used by every client in the process for ``window``.
+    """
+    with _batchers_lock:
+        if window not in _batchers:
+            _batchers[window] = DescribeBatcher(window)
+        return _batchers[window]
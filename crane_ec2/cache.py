@@ -0,0 +1,177 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class CachedError(Exception):
+    """
+    Raised in place of the error the process loading an entry got, for as
+    long as that error is cached.
+    """
+
+    def __init__(self, status, reason):
+        Exception.__init__(self, status, reason)
+        self.status = status
+        self.reason = reason
+
+
+class SQLiteCache(object):
+    """
+    Instance state cache stored in a local SQLite file, so every process on
+    the host shares the same entries.
+
+    Entries younger than ``ttl`` are served as they are. Entries older than
+    that, but still within ``stale_ttl``, are served stale while a single
+    process refreshes them. Missing and expired entries are loaded by a
+    single process too, the others poll for its result. "Not found" results
+    and errors are cached for ``negative_ttl`` seconds, so the processes
+    waiting for them don't fetch again.
+
+    A process holds the lock on an entry for at most ``lock_timeout``
+    seconds. Processes that waited ``wait_timeout`` seconds for a lock take
+    it over, in case its holder died.
+    """
+
+    def __init__(self, path, ttl=5, stale_ttl=30, negative_ttl=1, lock_timeout=5, wait_timeout=5,
+                 poll_interval=0.05):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        conn = self._connect()
+        try:
+            # readers don't block behind the refresher's writes.
+            conn.execute("PRAGMA journal_mode=WAL")
+            # state is one of loading, found, missing or error.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS instances ("
+                "key TEXT PRIMARY KEY, "
+                "state TEXT NOT NULL, "
+                "value TEXT, "
+                "updated_at REAL NOT NULL, "
+                "refreshing_until REAL NOT NULL DEFAULT 0)"
+            )
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # autocommit, every statement is atomic on its own.
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def get(self, key, fetch):
+        """
+        Returns the cached value for ``key``, calling ``fetch`` to (re)load it
+        when needed. Raises ``CachedError`` while the last ``fetch`` error is
+        cached.
+        """
+        conn = self._connect()
+        try:
+            holder, deadline = None, None
+            while True:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT state, value, updated_at, refreshing_until FROM instances WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[0] != "loading":
+                    state, value, age = row[0], json.loads(row[1]), now - row[2]
+                    if age < (self.ttl if state == "found" else self.negative_ttl):
+                        return self._unpack(state, value)
+                token = self._acquire(conn, key, now)
+                if token is not None:
+                    break
+                if row is not None and row[0] == "found" and age < self.stale_ttl:
+                    return value
+                if row is not None and row[3] != holder:
+                    # only locks held unchanged for wait_timeout are taken over.
+                    holder, deadline = row[3], now + self.wait_timeout
+                elif holder and now >= deadline:
+                    token = self._take_over(conn, key, holder, now)
+                    if token is not None:
+                        break
+                time.sleep(self.poll_interval)
+            try:
+                value = fetch()
+            except Exception as exc:
+                error = {"status": getattr(exc, "status", None), "reason": getattr(exc, "reason", str(exc))}
+                self._store(conn, key, "error", error, token)
+                raise
+            self._store(conn, key, "found" if value is not None else "missing", value, token)
+            return value
+        finally:
+            conn.close()
+
+    def _unpack(self, state, value):
+        if state == "error":
+            raise CachedError(value["status"], value["reason"])
+        return value
+
+    def _acquire(self, conn, key, now):
+        """
+        Locks the entry for ``key``, adding a placeholder row when there is
+        none. Returns the lock token, or ``None`` if another process holds it.
+        """
+        token = now + self.lock_timeout
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO instances (key, state, value, updated_at, refreshing_until) "
+            "VALUES (?, 'loading', NULL, 0, ?)",
+            (key, token),
+        )
+        if cursor.rowcount != 1:
+            # entries stored since they were read are fresh, leave them be.
+            cursor = conn.execute(
+                "UPDATE instances SET refreshing_until = ? WHERE key = ? AND refreshing_until < ? "
+                "AND updated_at <= CASE state WHEN 'found' THEN ? ELSE ? END",
+                (token, key, now, now - self.ttl, now - self.negative_ttl),
+            )
+        if cursor.rowcount == 1:
+            return token
+        return None
+
+    def _take_over(self, conn, key, holder_token, now):
+        """
+        Takes the lock on ``key`` from the holder of ``holder_token``. Returns
+        the new lock token, or ``None`` if the lock changed hands meanwhile.
+        """
+        token = now + self.lock_timeout
+        cursor = conn.execute(
+            "UPDATE instances SET refreshing_until = ? WHERE key = ? AND refreshing_until = ?",
+            (token, key, holder_token),
+        )
+        if cursor.rowcount == 1:
+            return token
+        return None
+
+    def _store(self, conn, key, state, value, token):
+        # only writes while the lock is still ours, so entries deleted during
+        # the refresh are not brought back.
+        conn.execute(
+            "UPDATE instances SET state = ?, value = ?, updated_at = ?, refreshing_until = 0 "
+            "WHERE key = ? AND refreshing_until = ?",
+            (state, json.dumps(value), time.time(), key, token),
+        )
+
+    def delete(self, key):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM instances WHERE key = ?", (key,))
+        finally:
+            conn.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def shared_cache(path, ttl, stale_ttl, negative_ttl):
+    """
+    Returns the cache used by every client in the process for ``path``.
+    """
+    key = (path, ttl, stale_ttl, negative_ttl)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = SQLiteCache(path, ttl=ttl, stale_ttl=stale_ttl, negative_ttl=negative_ttl)
+        return _caches[key]
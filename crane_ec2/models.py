@@ -1,4 +1,5 @@
 import logging
+import sqlite3
 
 import boto
 
@@ -6,11 +7,25 @@ from boto.ec2.regioninfo import RegionInfo
 from boto.exception import EC2ResponseError
 from django.conf import settings
 
+from crane_ec2.batch import shared_batcher
+from crane_ec2.cache import CachedError, shared_cache
+
+
+def _snapshot(ec2_instance):
+    return {
+        "id": ec2_instance.id,
+        "state": ec2_instance.state,
+        "ip_address": ec2_instance.ip_address,
+        "private_ip_address": ec2_instance.private_ip_address,
+    }
+
 
 class Client(object):
 
-    def __init__(self):
+    def __init__(self, cache=None, batcher=None):
         self._ec2_conn = None
+        self._cache = cache
+        self._batcher = batcher
 
     @property
     def ec2_conn(self):
@@ -25,6 +40,26 @@ class Client(object):
             )
         return self._ec2_conn
 
+    @property
+    def cache(self):
+        if not self._cache and getattr(settings, "EC2_CACHE_PATH", None):
+            try:
+                self._cache = shared_cache(
+                    settings.EC2_CACHE_PATH,
+                    ttl=float(getattr(settings, "EC2_CACHE_TTL", 5)),
+                    stale_ttl=float(getattr(settings, "EC2_CACHE_STALE_TTL", 30)),
+                    negative_ttl=float(getattr(settings, "EC2_CACHE_NEGATIVE_TTL", 1)),
+                )
+            except sqlite3.Error as exc:
+                logging.error("Error opening instance cache %s: %s" % (settings.EC2_CACHE_PATH, exc))
+        return self._cache
+
+    @property
+    def batcher(self):
+        if not self._batcher and getattr(settings, "EC2_COALESCE_WINDOW", None):
+            self._batcher = shared_batcher(float(settings.EC2_COALESCE_WINDOW))
+        return self._batcher
+
     def run(self, instance):
         try:
             reservation = self.ec2_conn.run_instances(
@@ -42,23 +77,55 @@ class Client(object):
         terminated = self.ec2_conn.terminate_instances(
                                 instance_ids=[instance.ec2_id])
         if instance.ec2_id in [inst.id for inst in terminated]:
+            if self.cache:
+                try:
+                    self.cache.delete(instance.ec2_id)
+                except sqlite3.Error as exc:
+                    logging.error("Error removing instance %s from cache: %s" % (instance.ec2_id, exc))
             return True
         logging.error("Failed to terminate the machine.")
         return False
 
+    def _describe_many(self, ec2_ids):
+        reservations = self.ec2_conn.get_all_instances(instance_ids=ec2_ids)
+        return dict((inst.id, _snapshot(inst)) for r in reservations for inst in r.instances)
+
+    def _describe(self, ec2_id):
+        if self.batcher:
+            return self.batcher.describe(ec2_id, self._describe_many)
+        reservation = self.ec2_conn.get_all_instances(instance_ids=[ec2_id])
+        if reservation and reservation[0].instances:
+            return _snapshot(reservation[0].instances[0])
+        return None
+
+    def _cached_describe(self, ec2_id):
+        if not self.cache:
+            return self._describe(ec2_id)
+        described = []
+
+        def describe():
+            described.append(self._describe(ec2_id))
+            return described[0]
+        try:
+            return self.cache.get(ec2_id, describe)
+        except sqlite3.Error as exc:
+            logging.error("Error reading instance %s from cache: %s" % (ec2_id, exc))
+            if described:
+                return described[0]
+            return self._describe(ec2_id)
+
     def get(self, instance):
         try:
-            reservation = self.ec2_conn.get_all_instances(instance_ids=[instance.ec2_id])
-        except EC2ResponseError as exc:
+            ec2_instance = self._cached_describe(instance.ec2_id)
+        except (EC2ResponseError, CachedError) as exc:
             logging.error("Error getting instance %s: %s - %s" % (instance.ec2_id, exc.status, exc.reason))
             return False
-        if reservation and reservation[0].instances:
-            ec2_instance = reservation[0].instances[0]
-            if ec2_instance.id == instance.ec2_id and ec2_instance.ip_address != ec2_instance.private_ip_address:
-                instance.state = ec2_instance.state
-                instance.host = ec2_instance.ip_address
+        if ec2_instance:
+            if ec2_instance["id"] == instance.ec2_id and ec2_instance["ip_address"] != ec2_instance["private_ip_address"]:
+                instance.state = ec2_instance["state"]
+                instance.host = ec2_instance["ip_address"]
                 return True
-            logging.info("Instance %s not updated. State: %s, IP: %s." % (ec2_instance.id, ec2_instance.state, ec2_instance.ip_address))
+            logging.info("Instance %s not updated. State: %s, IP: %s." % (ec2_instance["id"], ec2_instance["state"], ec2_instance["ip_address"]))
             return False
         logging.error("Instance %s not found." % instance.ec2_id)
         return False
@@ -1,3 +1,9 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
 import mocker
 
 from boto.ec2.regioninfo import RegionInfo
@@ -5,6 +11,8 @@ from boto.exception import EC2ResponseError
 from django.conf import settings
 
 from crane_ec2 import Client
+from crane_ec2.batch import DescribeBatcher
+from crane_ec2.cache import SQLiteCache, shared_cache
 from crane_ec2.tests import mocks
 
 
@@ -265,3 +273,252 @@ class EC2ClientTestCase(mocker.MockerTestCase):
         client._ec2_conn.revoke_security_group = fail_to_authorize
         client.unauthorize(instance)
         self.mocker.verify()
+
+
+class CachedClientTestCase(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = SQLiteCache(os.path.join(self.tmpdir, "cache.db"), ttl=60, stale_ttl=120)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _age_entry(self, ec2_id, seconds):
+        conn = self.cache._connect()
+        conn.execute("UPDATE instances SET updated_at = ? WHERE key = ?", (time.time() - seconds, ec2_id))
+        conn.close()
+
+    def _lock_entry(self, ec2_id):
+        conn = self.cache._connect()
+        token = self.cache._acquire(conn, ec2_id, time.time())
+        conn.close()
+        return token
+
+    def _read_entry(self, ec2_id):
+        conn = self.cache._connect()
+        row = conn.execute(
+            "SELECT state, value, refreshing_until FROM instances WHERE key = ?", (ec2_id,)
+        ).fetchone()
+        conn.close()
+        return row
+
+    def _store_later(self, ec2_id, state, value, token):
+        def store():
+            conn = self.cache._connect()
+            self.cache._store(conn, ec2_id, state, value, token)
+            conn.close()
+        timer = threading.Timer(0.2, store)
+        timer.start()
+        return timer
+
+    def test_get_should_serve_fresh_entries_from_the_cache_without_describing_again(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=0)
+        self.assertTrue(client.get(instance))
+        other = Client(cache=SQLiteCache(self.cache.path, ttl=60, stale_ttl=120))
+        other._ec2_conn = mocks.FakeEC2Conn(times_to_fail=0)
+        self.assertTrue(other.get(instance))
+        self.assertEqual([["i-00000302"]], client._ec2_conn.described)
+        self.assertEqual([], other._ec2_conn.described)
+        self.assertEqual("10.10.10.10", instance.host)
+
+    def test_get_should_refresh_stale_entries_once_and_serve_the_stale_value_meanwhile(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=1)
+        self.assertFalse(client.get(instance))
+        self._age_entry("i-00000302", 90)
+        token = self._lock_entry("i-00000302")
+        self.assertTrue(token)
+        self.assertFalse(client.get(instance))
+        self.assertEqual(1, len(client._ec2_conn.described))
+        conn = self.cache._connect()
+        conn.execute("UPDATE instances SET refreshing_until = 0 WHERE key = ?", ("i-00000302",))
+        conn.close()
+        self.assertTrue(client.get(instance))
+        self.assertTrue(client.get(instance))
+        self.assertEqual(2, len(client._ec2_conn.described))
+        state, value, refreshing_until = self._read_entry("i-00000302")
+        self.assertEqual("found", state)
+        self.assertIn('"10.10.10.10"', value)
+        self.assertEqual(0, refreshing_until)
+
+    def test_get_should_describe_again_when_the_entry_is_too_old_to_be_served(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=1)
+        self.assertFalse(client.get(instance))
+        self._age_entry("i-00000302", 150)
+        self.assertTrue(client.get(instance))
+        self.assertEqual(2, len(client._ec2_conn.described))
+
+    def test_get_should_cache_instances_that_were_not_found_for_negative_ttl_only(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FailingEC2Conn()
+        self.assertFalse(client.get(instance))
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=0)
+        self.assertFalse(client.get(instance))
+        self.assertEqual([], client._ec2_conn.described)
+        self._age_entry("i-00000302", 2)
+        self.assertTrue(client.get(instance))
+        self.assertEqual([["i-00000302"]], client._ec2_conn.described)
+
+    def test_terminate_should_remove_the_instance_from_the_cache(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=1)
+        self.assertFalse(client.get(instance))
+        self.assertTrue(client.terminate(instance))
+        self.assertTrue(client.get(instance))
+        self.assertEqual(2, len(client._ec2_conn.described))
+
+    def test_get_should_wait_for_the_process_loading_a_missing_entry_instead_of_describing(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        token = self._lock_entry("i-00000302")
+        timer = self._store_later("i-00000302", "found", {
+            "id": "i-00000302",
+            "state": "running",
+            "ip_address": "10.10.10.10",
+            "private_ip_address": "172.16.52.10",
+        }, token)
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=0)
+        self.assertTrue(client.get(instance))
+        timer.join()
+        self.assertEqual([], client._ec2_conn.described)
+
+    def test_get_should_not_describe_again_when_the_process_loading_the_entry_fails(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        token = self._lock_entry("i-00000302")
+        timer = self._store_later("i-00000302", "error", {"status": 503, "reason": "RequestLimitExceeded"}, token)
+        err = self.mocker.replace("logging.error")
+        err("Error getting instance i-00000302: 503 - RequestLimitExceeded")
+        self.mocker.result(None)
+        self.mocker.replay()
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=0)
+        self.assertFalse(client.get(instance))
+        timer.join()
+        self.assertEqual([], client._ec2_conn.described)
+        self.mocker.verify()
+
+    def test_get_should_take_over_locks_abandoned_by_dead_processes(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        self.cache.lock_timeout = 30
+        self._lock_entry("i-00000302")
+        self.cache.wait_timeout = 0.2
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=0)
+        self.assertTrue(client.get(instance))
+        self.assertEqual([["i-00000302"]], client._ec2_conn.described)
+        state, value, refreshing_until = self._read_entry("i-00000302")
+        self.assertEqual("found", state)
+        self.assertEqual(0, refreshing_until)
+
+    def test_get_should_not_bring_back_entries_deleted_during_a_refresh(self):
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=0)
+        describe = client._describe
+
+        def describe_and_delete(ec2_id):
+            value = describe(ec2_id)
+            self.cache.delete(ec2_id)
+            return value
+        client._describe = describe_and_delete
+        self.assertTrue(client.get(instance))
+        conn = self.cache._connect()
+        row = conn.execute("SELECT * FROM instances WHERE key = ?", ("i-00000302",)).fetchone()
+        conn.close()
+        self.assertIsNone(row)
+
+    def test_get_should_describe_the_instance_when_the_cache_fails(self):
+        conn = self.cache._connect()
+        conn.execute("DROP TABLE instances")
+        conn.close()
+        instance = Instance(name="good_news_first", ec2_id="i-00000302")
+        client = Client(cache=self.cache)
+        client._ec2_conn = mocks.FakeEC2Conn(times_to_fail=0)
+        self.assertTrue(client.get(instance))
+        self.assertEqual([["i-00000302"]], client._ec2_conn.described)
+
+    def test_shared_cache_should_return_the_same_cache_for_the_same_path(self):
+        path = os.path.join(self.tmpdir, "shared.db")
+        self.assertIs(shared_cache(path, 60, 120, 1), shared_cache(path, 60, 120, 1))
+
+
+class CoalescedClientTestCase(mocker.MockerTestCase):
+
+    def _get_concurrently(self, conn, batcher, instances):
+        results = {}
+
+        def get(instance):
+            client = Client(batcher=batcher)
+            client._ec2_conn = conn
+            results[instance.name] = client.get(instance)
+        threads = [threading.Thread(target=get, args=(instance,)) for instance in instances]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_get_should_merge_concurrent_calls_into_a_single_describe(self):
+        conn = mocks.FakeEC2Conn(times_to_fail=0)
+        instances = [Instance(name="instance-%d" % i, ec2_id="i-00%d" % i) for i in range(3)]
+        results = self._get_concurrently(conn, DescribeBatcher(window=0.2), instances)
+        self.assertEqual(1, len(conn.described))
+        self.assertEqual(["i-000", "i-001", "i-002"], sorted(conn.described[0]))
+        self.assertEqual([True, True, True], sorted(results.values()))
+        self.assertEqual(["10.10.10.10"] * 3, [instance.host for instance in instances])
+
+    def test_get_should_share_the_describe_for_identical_concurrent_calls(self):
+        conn = mocks.FakeEC2Conn(times_to_fail=0)
+        instances = [Instance(name="instance-%d" % i, ec2_id="i-00000302") for i in range(3)]
+        results = self._get_concurrently(conn, DescribeBatcher(window=0.2), instances)
+        self.assertEqual([["i-00000302"]], conn.described)
+        self.assertEqual([True, True, True], sorted(results.values()))
+
+    def _fail_describes(self, conn, error, should_fail):
+        calls = []
+        get_all_instances = conn.get_all_instances
+
+        def describe(instance_ids, *args, **kwargs):
+            calls.append(sorted(instance_ids))
+            if should_fail(instance_ids):
+                raise error
+            return get_all_instances(instance_ids, *args, **kwargs)
+        conn.get_all_instances = describe
+        return calls
+
+    def test_get_should_describe_again_without_the_invalid_ids_when_the_merged_describe_has_them(self):
+        conn = mocks.FakeEC2Conn(times_to_fail=0)
+        error = mocks.build_ec2_error(400, "Bad Request", "InvalidInstanceID.NotFound",
+                                      "The instance ID 'i-bad' does not exist")
+        calls = self._fail_describes(conn, error, lambda ids: "i-bad" in ids)
+        instances = [Instance(name=name, ec2_id="i-%s" % name) for name in ("good", "better", "bad")]
+        results = self._get_concurrently(conn, DescribeBatcher(window=0.2), instances)
+        self.assertEqual({"good": True, "better": True, "bad": False}, results)
+        self.assertEqual([["i-bad", "i-better", "i-good"], ["i-better", "i-good"]], calls)
+
+    def test_get_should_fail_every_instance_when_the_invalid_ids_are_not_named(self):
+        conn = mocks.FakeEC2Conn(times_to_fail=0)
+        error = mocks.build_ec2_error(400, "Bad Request", "InvalidInstanceID.Malformed", "Invalid id")
+        calls = self._fail_describes(conn, error, lambda ids: "i-bad" in ids)
+        instances = [Instance(name="good", ec2_id="i-good"), Instance(name="bad", ec2_id="i-bad")]
+        results = self._get_concurrently(conn, DescribeBatcher(window=0.2), instances)
+        self.assertEqual({"good": False, "bad": False}, results)
+        self.assertEqual([["i-bad", "i-good"]], calls)
+
+    def test_get_should_not_describe_again_when_the_merged_describe_is_throttled(self):
+        conn = mocks.FakeEC2Conn(times_to_fail=0)
+        error = mocks.build_ec2_error(503, "Service Unavailable", "RequestLimitExceeded", "Request limit exceeded.")
+        calls = self._fail_describes(conn, error, lambda ids: True)
+        instances = [Instance(name="instance-%d" % i, ec2_id="i-00%d" % i) for i in range(10)]
+        results = self._get_concurrently(conn, DescribeBatcher(window=0.2), instances)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(10, len(calls[0]))
+        self.assertEqual([False] * 10, list(results.values()))
@@ -24,12 +24,19 @@ def build_running_reservations(instance_id):
     return [r]
 
 
+def build_ec2_error(status, reason, code, message):
+    body = ("<Response><Errors><Error><Code>%s</Code><Message>%s</Message></Error></Errors>"
+            "<RequestID>ea966190-f9aa-478e-9ede-example</RequestID></Response>") % (code, message)
+    return EC2ResponseError(status, reason, body)
+
+
 class FakeEC2Conn(object):
 
     def __init__(self, times_to_fail=1, *args, **kwargs):
         self.authorizations = []
         self.instances = []
         self.terminated = []
+        self.described = []
         self.args = args
         self.kwargs = kwargs
         self.times_to_fail = times_to_fail
@@ -57,10 +64,16 @@ class FakeEC2Conn(object):
         return instances
 
     def get_all_instances(self, instance_ids, *args, **kwargs):
+        self.described.append(list(instance_ids))
         if self.fails < self.times_to_fail:
             self.fails += 1
-            return build_pending_reservations(instance_ids[0])
-        return build_running_reservations(instance_ids[0])
+            build = build_pending_reservations
+        else:
+            build = build_running_reservations
+        reservations = []
+        for instance_id in instance_ids:
+            reservations.extend(build(instance_id))
+        return reservations
 
     def _build_authorization_string(self, kw):
         items = ["%s=%s" % (k, v) for k, v in kw.iteritems()]